@@ -14,6 +14,11 @@ import glob
 import datetime
 import io
 import csv
+import hashlib
+import uuid
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 def repair_multiline_csv(file_path):
     """Read a CSV file and join lines that start with a comma to the previous line."""
@@ -223,12 +228,356 @@ def load_patient_list():
     else:
         return pd.DataFrame(columns=['PHN', 'last_name', 'first_name', 'date_of_birth', 'diagnosis'])
 
+# Per-patient and per-facility diagnosis usage, used to prefill and shortlist codes
+DIAGNOSIS_USAGE_PATH = 'Diagnosis_Usage.csv'
+DIAGNOSIS_USAGE_COLUMNS = ['scope', 'key', 'code', 'last_used', 'service_dates']
+
+# Number of codes kept per patient and per facility, and how many of those slots
+# always go to the most recently used codes
+MAX_PATIENT_DIAGNOSES = 8
+MAX_FACILITY_DIAGNOSES = 30
+DIAGNOSIS_RECENT_SLOTS = 3
+
+# Each use of a code counts for half as much after this many days
+DIAGNOSIS_HALF_LIFE_DAYS = 90
+
+# Service dates remembered per code so each date is only counted once
+MAX_DIAGNOSIS_SERVICE_DATES = 20
+
+def load_diagnosis_usage():
+    if os.path.exists(DIAGNOSIS_USAGE_PATH):
+        return pd.read_csv(DIAGNOSIS_USAGE_PATH, dtype={'scope': str, 'key': str, 'code': str, 'last_used': str, 'service_dates': str})
+    else:
+        return pd.DataFrame(columns=DIAGNOSIS_USAGE_COLUMNS)
+
+def parse_service_date(value, today):
+    """Return a 'YYYY-MM-DD' value as a date, or today if it is blank or invalid."""
+    try:
+        return datetime.datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+    except ValueError:
+        return today
+
+def diagnosis_usage_score(service_dates, today):
+    """Score a code from its 'YYYY-MM-DD' service dates, each use decaying with DIAGNOSIS_HALF_LIFE_DAYS."""
+    return sum(
+        0.5 ** (max((today - parse_service_date(service_date, today)).days, 0) / DIAGNOSIS_HALF_LIFE_DAYS)
+        for service_date in service_dates
+    )
+
+def record_diagnosis_usage(usage_df, claims_df, today=None):
+    """Count each patient's and facility's diagnoses from claims_df, then trim the store to its size limits.
+
+    Uses are keyed on the row's date_of_service (today if blank), so each code is counted once per
+    patient/facility per service date no matter how often the same rows are saved.
+    Rows with billing codes that auto-set L23 are ignored. Returns the updated usage dataframe.
+    """
+    today = today or datetime.date.today()
+
+    entries = {}
+    for scope, key, code, service_dates in zip(usage_df['scope'], usage_df['key'], usage_df['code'], usage_df['service_dates']):
+        entries[(scope, key, code)] = {'service_dates': set(str(service_dates).split(';'))}
+
+    recorded = set()
+    for _, row in claims_df.iterrows():
+        code = extract_diagnosis_code(row['diagnosis'])
+        if not code or row['billing_item'] in L23_BILLING_CODES:
+            continue
+        service_date = parse_service_date(row['date_of_service'], today).strftime("%Y-%m-%d")
+        for scope, key in (('patient', row['PHN']), ('facility', row['facility_code'])):
+            if pd.isna(key) or not str(key):
+                continue
+            entry = entries.setdefault((scope, str(key), code), {'service_dates': set()})
+            if service_date in entry['service_dates']:
+                continue
+            # Older than every remembered date, so there is no way to tell whether it was already counted
+            if len(entry['service_dates']) >= MAX_DIAGNOSIS_SERVICE_DATES and service_date < min(entry['service_dates']):
+                continue
+            entry['service_dates'].add(service_date)
+            if len(entry['service_dates']) > MAX_DIAGNOSIS_SERVICE_DATES:
+                entry['service_dates'].remove(min(entry['service_dates']))
+            recorded.add((scope, str(key), code))
+
+    grouped = {}
+    for scope, key, code in entries:
+        grouped.setdefault((scope, key), []).append(code)
+
+    rows = []
+    for (scope, key), codes in grouped.items():
+        limit = MAX_PATIENT_DIAGNOSES if scope == 'patient' else MAX_FACILITY_DIAGNOSES
+        scores = {code: diagnosis_usage_score(entries[(scope, key, code)]['service_dates'], today) for code in codes}
+        last_used = {code: max(entries[(scope, key, code)]['service_dates']) for code in codes}
+        by_score = sorted(codes, key=lambda code: (scores[code], last_used[code]), reverse=True)
+        by_recency = sorted(codes, key=lambda code: (last_used[code], scores[code]), reverse=True)
+        # Codes from this save are kept first so a new code can build up a score,
+        # then the most recently used codes, then the highest scoring ones
+        kept = []
+        for candidates in ([code for code in by_score if (scope, key, code) in recorded], by_recency[:DIAGNOSIS_RECENT_SLOTS], by_score):
+            for code in candidates:
+                if len(kept) < limit and code not in kept:
+                    kept.append(code)
+        for code in kept:
+            entry = entries[(scope, key, code)]
+            rows.append({
+                'scope': scope,
+                'key': key,
+                'code': code,
+                'last_used': last_used[code],
+                'service_dates': ';'.join(sorted(entry['service_dates']))
+            })
+    return pd.DataFrame(rows, columns=DIAGNOSIS_USAGE_COLUMNS)
+
+def build_diagnosis_shortlists(usage_df, today=None):
+    """Map ('patient', PHN) and ('facility', facility_code) to their most recent code and their codes ordered by decayed score."""
+    today = today or datetime.date.today()
+    grouped = {}
+    for scope, key, code, last_used, service_dates in zip(
+        usage_df['scope'], usage_df['key'], usage_df['code'], usage_df['last_used'], usage_df['service_dates']
+    ):
+        score = diagnosis_usage_score(str(service_dates).split(';'), today)
+        grouped.setdefault((scope, key), []).append((score, last_used, code))
+    return {
+        scope_key: {
+            'latest': max(codes, key=lambda entry: (entry[1], entry[0]))[2],
+            'ranked': [code for _, _, code in sorted(codes, reverse=True)]
+        }
+        for scope_key, codes in grouped.items()
+    }
+
+@st.cache_data
+def load_diagnosis_shortlists(usage_mtime, today):
+    """Build the diagnosis shortlists once per version of the usage file and day (both are only cache keys)."""
+    return build_diagnosis_shortlists(load_diagnosis_usage(), today)
+
+def get_latest_diagnosis(shortlists, phn):
+    """Return the patient's most recently used code, or '' if there is none."""
+    return shortlists.get(('patient', str(phn)), {}).get('latest', '')
+
+def get_preferred_diagnoses(shortlists, phn, facility_code):
+    """Return the patient's usual codes followed by the facility's, without repeats."""
+    preferred = list(shortlists.get(('patient', str(phn)), {}).get('ranked', []))
+    for code in shortlists.get(('facility', facility_code), {}).get('ranked', []):
+        if code not in preferred:
+            preferred.append(code)
+    return preferred
+
+# Append-only claims history: one Parquet file per finalize, partitioned as
+# claims_history/date_of_service=YYYY-MM-DD/facility_code=XXXXX/part-*.parquet
+CLAIMS_HISTORY_PATH = 'claims_history'
+# Hashed key index on (PHN, date_of_service, billing_item); the leading underscore
+# keeps pyarrow from treating it as part of the claims dataset
+CLAIMS_INDEX_PATH = os.path.join(CLAIMS_HISTORY_PATH, '_key_index')
+# Markers for finalizes still being written, used to repair the index after a crash
+CLAIMS_PENDING_PATH = os.path.join(CLAIMS_HISTORY_PATH, '_pending')
+
+# Merge the per-finalize index files into one once there are more than this many
+CLAIM_INDEX_MERGE_THRESHOLD = 20
+
+CLAIM_COLUMNS = ['date_of_service', 'last_name', 'first_name', 'PHN', 'date_of_birth', 'billing_item', 'diagnosis', 'location', 'facility_code', 'start_time', 'end_time', 'rural_premium']
+CLAIM_INDEX_COLUMNS = ['claim_key', 'PHN', 'date_of_service', 'billing_item', 'facility_code']
+
+CLAIMS_PARTITIONING = ds.partitioning(
+    pa.schema([('date_of_service', pa.string()), ('facility_code', pa.string())]),
+    flavor='hive'
+)
+
+def make_claim_key(phn, date_of_service, billing_item):
+    """Hash (PHN, date_of_service, billing_item) into the key stored in the claims index."""
+    raw = f"{str(phn).strip()}|{str(date_of_service).strip()}|{str(billing_item).strip()}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def write_parquet_atomic(table, path):
+    """Write table to path through a hidden temporary file so readers never see a partial file."""
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+def repair_claim_index():
+    """Write the index file for any finalize that stopped before its index file was written.
+
+    Before writing its partitions, a finalize leaves a marker in _pending listing their paths and
+    removes it once its index file is in place. For a leftover marker, the index file is rebuilt
+    from the claim_key, PHN and billing_item stored in the partitions that were written.
+    """
+    if not os.path.exists(CLAIMS_PENDING_PATH):
+        return
+    index_schema = pa.schema([(col, pa.string()) for col in CLAIM_INDEX_COLUMNS])
+    for part_name in os.listdir(CLAIMS_PENDING_PATH):
+        if part_name.startswith('.'):
+            continue
+        marker_path = os.path.join(CLAIMS_PENDING_PATH, part_name)
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            written_paths = [line.strip() for line in f if line.strip() and os.path.exists(line.strip())]
+        index_path = os.path.join(CLAIMS_INDEX_PATH, part_name)
+        if written_paths and not os.path.exists(index_path):
+            dataset = ds.dataset(written_paths, format='parquet', partitioning=CLAIMS_PARTITIONING, partition_base_dir=CLAIMS_HISTORY_PATH)
+            os.makedirs(CLAIMS_INDEX_PATH, exist_ok=True)
+            write_parquet_atomic(dataset.to_table(columns=CLAIM_INDEX_COLUMNS).cast(index_schema), index_path)
+        try:
+            os.remove(marker_path)
+        except FileNotFoundError:
+            pass  # Already repaired from another session
+
+def merge_claim_index():
+    """Merge the index files into a single file once there are more than CLAIM_INDEX_MERGE_THRESHOLD of them."""
+    index_paths = [
+        os.path.join(CLAIMS_INDEX_PATH, name)
+        for name in os.listdir(CLAIMS_INDEX_PATH)
+        if not name.startswith('.')
+    ]
+    if len(index_paths) <= CLAIM_INDEX_MERGE_THRESHOLD:
+        return
+    index_table = ds.dataset(index_paths, format='parquet').to_table(columns=CLAIM_INDEX_COLUMNS)
+    # Keys are only ever added, so a crash before the old files are removed just leaves harmless repeats
+    write_parquet_atomic(index_table, os.path.join(CLAIMS_INDEX_PATH, f"merged-{uuid.uuid4().hex}.parquet"))
+    for path in index_paths:
+        os.remove(path)
+
+def load_claim_keys():
+    """Return the set of claim keys already in the claims history (reads only the index)."""
+    if not os.path.exists(CLAIMS_HISTORY_PATH):
+        return set()
+    repair_claim_index()
+    if not os.path.exists(CLAIMS_INDEX_PATH):
+        return set()
+    table = ds.dataset(CLAIMS_INDEX_PATH, format='parquet').to_table(columns=['claim_key'])
+    return set(table.column('claim_key').to_pylist())
+
+def prepare_claims(df):
+    """Normalize claim rows to string columns, drop incomplete rows and add the claim key."""
+    claims = df.reindex(columns=CLAIM_COLUMNS).fillna('').astype(str)
+    claims = claims[
+        (claims['PHN'].str.strip() != '') &
+        (claims['date_of_service'].str.strip() != '') &
+        (claims['billing_item'].str.strip() != '')
+    ].copy()
+    claims['claim_key'] = [
+        make_claim_key(phn, date_of_service, billing_item)
+        for phn, date_of_service, billing_item in zip(claims['PHN'], claims['date_of_service'], claims['billing_item'])
+    ]
+    return claims
+
+def find_duplicate_claims(df, existing_keys=None):
+    """Return the rows of df already billed, either in the claims history or earlier in the same batch.
+
+    The returned rows keep their original index and get a 'duplicate_of' column ('history' or 'batch').
+    """
+    if existing_keys is None:
+        existing_keys = load_claim_keys()
+    claims = prepare_claims(df)
+    in_history = claims['claim_key'].isin(existing_keys)
+    in_batch = claims['claim_key'].duplicated() & ~in_history
+    duplicates = claims[in_history | in_batch].copy()
+    duplicates['duplicate_of'] = ['history' if flag else 'batch' for flag in in_history[in_history | in_batch]]
+    return duplicates
+
+def append_claims_to_history(df, include_duplicates=False):
+    """Append finalized claim rows to the claims history.
+
+    Rows already billed (see find_duplicate_claims) are skipped unless include_duplicates is set,
+    e.g. for time-based codes billed twice in a day. Rows missing a PHN, date or billing code are
+    never written. Returns (claims written, skipped duplicate rows, number of incomplete rows).
+    """
+    claims = prepare_claims(df)
+    incomplete_count = len(df) - len(claims)
+    if include_duplicates:
+        skipped_duplicates = claims.iloc[0:0].assign(duplicate_of='')
+    else:
+        skipped_duplicates = find_duplicate_claims(df)
+        claims = claims.drop(index=skipped_duplicates.index)
+    if claims.empty:
+        return 0, skipped_duplicates, incomplete_count
+    claims['finalized_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    # Same file name in every partition and in the index so one finalize can be traced
+    # across them, and a finalize interrupted before its index file can be repaired
+    part_name = f"part-{uuid.uuid4().hex}.parquet"
+
+    data_columns = [col for col in claims.columns if col not in ('date_of_service', 'facility_code')]
+    data_schema = pa.schema([(col, pa.string()) for col in data_columns])
+    partitions = [
+        (os.path.join(CLAIMS_HISTORY_PATH, f"date_of_service={service_date}", f"facility_code={facility}", part_name), group)
+        for (service_date, facility), group in claims.groupby(['date_of_service', 'facility_code'])
+    ]
+
+    # Record which files this finalize writes before writing them
+    os.makedirs(CLAIMS_PENDING_PATH, exist_ok=True)
+    marker_path = os.path.join(CLAIMS_PENDING_PATH, part_name)
+    marker_tmp_path = os.path.join(CLAIMS_PENDING_PATH, f".{part_name}.tmp")
+    with open(marker_tmp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(path for path, _ in partitions))
+    os.replace(marker_tmp_path, marker_path)
+
+    for path, group in partitions:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.Table.from_pandas(group[data_columns], schema=data_schema, preserve_index=False)
+        write_parquet_atomic(table, path)
+
+    index_schema = pa.schema([(col, pa.string()) for col in CLAIM_INDEX_COLUMNS])
+    os.makedirs(CLAIMS_INDEX_PATH, exist_ok=True)
+    index_table = pa.Table.from_pandas(claims[CLAIM_INDEX_COLUMNS], schema=index_schema, preserve_index=False)
+    write_parquet_atomic(index_table, os.path.join(CLAIMS_INDEX_PATH, part_name))
+    os.remove(marker_path)
+
+    merge_claim_index()
+    return len(claims), skipped_duplicates, incomplete_count
+
+def query_claims_history(phn=None, start_date=None, end_date=None, billing_item=None, facility_code=None, columns=None):
+    """Query the claims history without loading all of it into memory.
+
+    Dates are inclusive 'YYYY-MM-DD' strings. Date and facility filters skip whole partitions,
+    and a PHN filter looks up the key index first so only that patient's service dates are read.
+    """
+    empty_result = pd.DataFrame(columns=columns or CLAIM_COLUMNS + ['finalized_at'])
+    if not os.path.exists(CLAIMS_HISTORY_PATH):
+        return empty_result
+
+    filters = []
+    if phn:
+        repair_claim_index()
+        if not os.path.exists(CLAIMS_INDEX_PATH):
+            return empty_result
+        index_table = ds.dataset(CLAIMS_INDEX_PATH, format='parquet').to_table(
+            columns=['date_of_service'],
+            filter=ds.field('PHN') == str(phn)
+        )
+        service_dates = sorted(set(index_table.column('date_of_service').to_pylist()))
+        if not service_dates:
+            return empty_result
+        filters.append(ds.field('date_of_service').isin(service_dates))
+        filters.append(ds.field('PHN') == str(phn))
+    if start_date:
+        filters.append(ds.field('date_of_service') >= str(start_date))
+    if end_date:
+        filters.append(ds.field('date_of_service') <= str(end_date))
+    if facility_code:
+        filters.append(ds.field('facility_code') == facility_code)
+    if billing_item:
+        filters.append(ds.field('billing_item') == str(billing_item))
+
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+
+    dataset = ds.dataset(CLAIMS_HISTORY_PATH, format='parquet', partitioning=CLAIMS_PARTITIONING)
+    if not dataset.files:
+        return empty_result
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
 # Configure Tesseract path for Windows
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\tesseract.exe'
 
 # Load diagnosis codes
 diagnosis_codes_df = load_diagnosis_codes()
 
+# Map each diagnosis code to its picker option so lookups don't scan the whole catalog
+diagnosis_option_by_code = {}
+for option in diagnosis_codes_df:
+    diagnosis_option_by_code.setdefault(option.split(' - ')[0].strip(), option)
+
+# Load the per-patient and per-facility diagnosis shortlists (cached until the usage file changes)
+diagnosis_usage_mtime = os.path.getmtime(DIAGNOSIS_USAGE_PATH) if os.path.exists(DIAGNOSIS_USAGE_PATH) else None
+diagnosis_shortlists = load_diagnosis_shortlists(diagnosis_usage_mtime, datetime.date.today())
+
 # Add facility code selection
 facility_code = st.selectbox(
     "Select Facility Code",
@@ -286,6 +635,8 @@ if uploaded_png is not None:
                 billing_code = phn_visit_type if phn_visit_type else ''
                 if not match_row.empty:
                     patient_info = match_row.iloc[0].to_dict()
+                    # Prefill with the patient's most recent diagnosis, falling back to the saved one
+                    latest_diagnosis = get_latest_diagnosis(diagnosis_shortlists, phn)
                     results.append({
                         'date_of_service': appointment_date if appointment_date else '',
                         'last_name': patient_info.get('last_name', ''),
@@ -293,7 +644,7 @@ if uploaded_png is not None:
                         'PHN': phn,
                         'date_of_birth': patient_info.get('date_of_birth', ''),
                         'billing_item': billing_code,
-                        'diagnosis': patient_info.get('diagnosis', ''),
+                        'diagnosis': latest_diagnosis if latest_diagnosis else patient_info.get('diagnosis', ''),
                         'location': 'L',
                         'facility_code': facility_code,
                         'start_time': '',
@@ -348,6 +699,9 @@ if uploaded_png is not None:
             current_df = st.session_state.df.copy()
             
             # Add a duplicate button for each row
+            # Diagnosis picker options reordered per (PHN, facility), built once per rerun
+            diagnosis_options_by_patient = {}
+            
             for idx in range(len(current_df)):
                 st.markdown(f"---")
                 st.markdown(f"**Row {idx + 1}**")
@@ -470,21 +824,28 @@ if uploaded_png is not None:
                             st.session_state.df.at[idx, 'diagnosis'] = 'L23'
                             st.info(f"✅ **Diagnosis automatically set to L23 for billing code {new_billing_code}**")
                         else:
+                            # Show the patient's and facility's usual codes first, then the rest of the catalog
+                            options_key = (row_data['PHN'], row_data['facility_code'])
+                            if options_key not in diagnosis_options_by_patient:
+                                diagnosis_options = diagnosis_codes_df if isinstance(diagnosis_codes_df, list) else []
+                                preferred_options = [
+                                    diagnosis_option_by_code[code]
+                                    for code in get_preferred_diagnoses(diagnosis_shortlists, row_data['PHN'], row_data['facility_code'])
+                                    if code in diagnosis_option_by_code
+                                ]
+                                preferred_set = set(preferred_options)
+                                diagnosis_options_by_patient[options_key] = [''] + preferred_options + [option for option in diagnosis_options if option not in preferred_set]
+                            diagnosis_options = diagnosis_options_by_patient[options_key]
+                            
                             # Find the matching diagnosis option
-                            diagnosis_options = diagnosis_codes_df if isinstance(diagnosis_codes_df, list) else []
                             current_diagnosis_option = None
-                            
                             if current_diagnosis:
-                                # Try to find the current diagnosis in the options
-                                for option in diagnosis_options:
-                                    if option.startswith(f"{current_diagnosis} -"):
-                                        current_diagnosis_option = option
-                                        break
+                                current_diagnosis_option = diagnosis_option_by_code.get(str(current_diagnosis))
                             
                             new_diagnosis = st.selectbox(
                                 "Diagnosis",
-                                options=[''] + diagnosis_options,
-                                index=diagnosis_options.index(current_diagnosis_option) + 1 if current_diagnosis_option else 0,
+                                options=diagnosis_options,
+                                index=diagnosis_options.index(current_diagnosis_option) if current_diagnosis_option else 0,
                                 key=f"diagnosis_{idx}",
                                 help="Select or search for a diagnosis code"
                             )
@@ -558,7 +919,7 @@ if uploaded_png is not None:
             
             # Add a button to clear all rows
             if st.button("🗑️ Clear All Rows"):
-                st.session_state.df = pd.DataFrame(columns=['date_of_service', 'last_name', 'first_name', 'PHN', 'date_of_birth', 'billing_item', 'diagnosis', 'location', 'facility_code', 'start_time', 'end_time', 'rural_premium'])
+                st.session_state.df = pd.DataFrame(columns=CLAIM_COLUMNS)
                 st.rerun()
             
             # Add a button to save all patient rows (with diagnosis) to Patient_List.csv
@@ -581,8 +942,37 @@ if uploaded_png is not None:
                             'diagnosis': entry['diagnosis']
                         }])], ignore_index=True)
                 updated_patients.to_csv(PATIENT_LIST_PATH, index=False)
+                # Update the diagnosis usage used to prefill and order the diagnosis picker
+                record_diagnosis_usage(load_diagnosis_usage(), st.session_state.df).to_csv(DIAGNOSIS_USAGE_PATH, index=False)
                 st.success("✅ Patient list updated with diagnosis.")
             
+            # Flag claims already billed in the claims history or repeated within this batch
+            # Reload the known claim keys whenever the index changes, e.g. after a finalize in another tab
+            claim_index_mtime = os.path.getmtime(CLAIMS_INDEX_PATH) if os.path.exists(CLAIMS_INDEX_PATH) else None
+            if 'claim_keys' not in st.session_state or st.session_state.get('claim_keys_mtime') != claim_index_mtime:
+                st.session_state.claim_keys = load_claim_keys()
+                st.session_state.claim_keys_mtime = claim_index_mtime
+            duplicate_claims = find_duplicate_claims(st.session_state.df, st.session_state.claim_keys)
+            for row_idx, duplicate in duplicate_claims.iterrows():
+                where = "the claims history" if duplicate['duplicate_of'] == 'history' else "an earlier row"
+                st.warning(f"⚠️ Row {row_idx + 1}: PHN {duplicate['PHN']} was already billed {duplicate['billing_item']} on {duplicate['date_of_service']} in {where}.")
+            include_duplicates = False
+            if not duplicate_claims.empty:
+                include_duplicates = st.checkbox(
+                    "Finalize flagged duplicate rows too",
+                    key="include_duplicate_claims",
+                    help="Use this when a flagged row is a separate claim, e.g. a time-based code billed again with different start/end times"
+                )
+            
+            # Add a button to append the finalized rows to the claims history
+            if st.button("📥 Finalize Claims to History"):
+                written, skipped_duplicates, incomplete_count = append_claims_to_history(st.session_state.df, include_duplicates)
+                st.success(f"✅ Saved {written} claim(s) to the claims history.")
+                for row_idx, duplicate in skipped_duplicates.iterrows():
+                    st.info(f"Skipped row {row_idx + 1}: PHN {duplicate['PHN']} already billed {duplicate['billing_item']} on {duplicate['date_of_service']}.")
+                if incomplete_count:
+                    st.info(f"Skipped {incomplete_count} incomplete row(s) missing a PHN, date of service or billing code.")
+            
             # Display final summary table
             st.header("📊 Final Summary Table")
             st.dataframe(
@@ -645,6 +1035,43 @@ if uploaded_png is not None:
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
 
+# --- Claims History Search in Sidebar ---
+with st.sidebar:
+    st.header("📚 Claims History")
+    history_phn = st.text_input("PHN", key="history_phn_sidebar")
+    history_month = st.text_input("Month (YYYY-MM)", key="history_month_sidebar")
+    history_billing = st.selectbox(
+        "Billing Code",
+        options=[''] + list(BILLING_CODES.keys()),
+        format_func=lambda x: f"{x} - {BILLING_CODES[x]}" if x else "Any",
+        key="history_billing_sidebar"
+    )
+    if st.button("Search Claims", key="history_search_btn_sidebar"):
+        month_start = month_end = None
+        month_valid = True
+        if history_month.strip():
+            try:
+                month_start = datetime.datetime.strptime(history_month.strip(), "%Y-%m").date()
+                # Last day of the month: first day of the next month minus one day
+                month_end = (month_start + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+            except ValueError:
+                month_valid = False
+                st.error(f"Invalid month '{history_month.strip()}'. Please use YYYY-MM, e.g. 2025-06.")
+        if month_valid and not (history_phn.strip() or month_start or history_billing):
+            st.info("Enter a PHN, month or billing code to search the claims history.")
+        elif month_valid:
+            try:
+                history_df = query_claims_history(
+                    phn=history_phn.strip() or None,
+                    start_date=month_start.strftime("%Y-%m-%d") if month_start else None,
+                    end_date=month_end.strftime("%Y-%m-%d") if month_end else None,
+                    billing_item=history_billing or None
+                )
+                st.write(f"{len(history_df)} claim(s) found")
+                st.dataframe(history_df, use_container_width=True)
+            except Exception as e:
+                st.error(f"Error searching claims history: {str(e)}")
+
 # --- Add New Diagnosis Code in Sidebar ---
 with st.sidebar:
     st.header("➕ Add New Diagnosis Code")